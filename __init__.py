@@ -2,29 +2,45 @@ import enum
 from enum import Enum
 import os
 import logging
-import glob
-from typing import Any
+import time
+from typing import Any, TypeVar
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from dataclasses import dataclass
 from functools import cached_property
 from gettext import gettext as _
 from threading import Lock
-
-from anki.notes import Note
-from anki.models import NotetypeId
-from anki.collection import Collection
+from weakref import WeakValueDictionary
+
+# The typeshed stubs lack the registry instance, which bs4 has exported for ages.
+from bs4.builder import builder_registry  # type: ignore[attr-defined]
+from anki.notes import Note, NoteId
+from anki.models import NotetypeDict, NotetypeId
+from anki.collection import Collection, OpChanges
+from anki.utils import split_fields
 import aqt
 from aqt.editor import EditorWebView, Editor
+from aqt.main import AnkiQt
 from aqt.qt import QMenu, qconnect
-from aqt.operations import QueryOp, CollectionOp, OpChanges
+from aqt.operations import QueryOp, CollectionOp
 
 from .thai_language.types import *
 from .thai_language.fetch import DictionaryFetcher, EntryNotFound, build_entry_url
 from .thai_language.refs import parse_any_ref, ref_to_string
-from .thai_language.note import ClozeNote, MediaName, NoteFormatter, WordNote
+from .thai_language.note import ClozeNote, MediaName, MediaPath, NoteFormatter, WordNote
 
 
 logger = logging.getLogger(__name__)
 
+# Mass operations load the model notes in chunks of this size.
+NOTES_CHUNK_SIZE = 256
+# Minimal interval between progress updates of mass operations, in seconds.
+PROGRESS_INTERVAL = 0.1
+# Media files of a single entry are downloaded concurrently by this many workers,
+# unless the operation already runs entries in parallel.
+MEDIA_WORKERS = 4
+
 
 class AnkiEntryNotFound(Exception):
     pass
@@ -35,14 +51,21 @@ class NoteType(Enum):
     CLOZE = enum.auto()
 
 
-# FIXME: Replace when Anki ships with Python 3.10
-# @dataclass(kw_only=True)
 @dataclass
+class NotetypeInfo:
+    type: NoteType
+    # Optional configured fields which the notetype has.
+    fields: frozenset[str]
+
+
+# FIXME: Replace when Anki ships with Python 3.10
+# @dataclass(kw_only=True, slots=True)
+@dataclass(**DATACLASS_SLOTS)
 class AnkiWordNote(WordNote):
     media_data: dict[MediaName, bytes] = field(default_factory=dict)
 
 
-@dataclass
+@dataclass(**DATACLASS_SLOTS)
 class PluginOptions:
     id_field: str = "Id"
     word_field: str = "Word"
@@ -52,13 +75,58 @@ class PluginOptions:
     cloze_text_field: str = "Text"
     cloze_extra_field: str = "Extra"
     pronounciation_type: str = "Paiboon"
+    # Fetching is I/O-bound, so this is bounded by what thai-language.com tolerates rather than by the CPU.
+    concurrency: int = 8
+    # BeautifulSoup tree builder for entry pages; "lxml" is faster, but needs to be installed separately.
+    html_parser: str = "html.parser"
 
     @staticmethod
     def from_dict(vals: dict[str, Any]) -> "PluginOptions":
         return PluginOptions(**vals)
 
     def to_dict(self) -> dict[str, Any]:
-        return dataclasses.asdict(self)
+        # All the options are flat, so there is no need for the deep copy done by asdict().
+        return {option.name: getattr(self, option.name) for option in dataclasses.fields(self)}
+
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+# Pending calls are cancelled as soon as the consumer leaves the block, including on errors.
+@contextmanager
+def _map_concurrently(f: Callable[[T], R], items: Iterable[T], *, max_workers: int) -> Iterator[Iterator[tuple[T, "Future[R]"]]]:
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = {executor.submit(f, item): item for item in items}
+        yield ((futures[future], future) for future in as_completed(futures))
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def _make_progress_reporter(mw: AnkiQt, label: str, total: int) -> Callable[[int], None]:
+    run_on_main = mw.taskman.run_on_main
+    update_progress = mw.progress.update
+    last_update: Optional[float] = None
+    def report(i: int):
+        nonlocal last_update
+        now = time.monotonic()
+        if last_update is not None and now - last_update < PROGRESS_INTERVAL and i != total - 1:
+            return
+        last_update = now
+        text = label.format(i + 1, total)
+        run_on_main(lambda: update_progress(label=text, value=i, max=total))
+    return report
+
+
+def _fields_to_fill(info: NotetypeInfo, fields: Optional[frozenset[str]]) -> frozenset[str]:
+    return info.fields if fields is None else info.fields & fields
+
+
+def _fill_fields(note: Note, fill_fields: frozenset[str], values: Iterable[tuple[str, str]]):
+    for name, value in values:
+        if name in fill_fields:
+            note[name] = value
 
 
 def _handle_failure(editor: Editor, e: Exception):
@@ -74,7 +142,10 @@ def _handle_failure(editor: Editor, e: Exception):
 
 class Plugin:
     _config: PluginOptions
-    _fetcher_lock: Lock
+    # Locks live only while somebody holds or waits for them.
+    _entry_locks: "WeakValueDictionary[Union[EntryId, str], Lock]"
+    _entry_locks_lock: Lock
+    _notetype_cache: dict[NotetypeId, Optional[NotetypeInfo]]
 
     def __init__(self):
         raw_cfg = aqt.mw.addonManager.getConfig(__name__)
@@ -86,40 +157,126 @@ class Plugin:
             except Exception as e:
                 aqt.utils.show_warning(f"Failed to load configuration: {e}")
                 self._reset_config()
-        self._fetcher_lock = Lock()
+            self._validate_config()
+        self._entry_locks = WeakValueDictionary()
+        self._entry_locks_lock = Lock()
+        self._notetype_cache = {}
+        self._init_shared_state()
 
         aqt.gui_hooks.editor_will_show_context_menu.append(self._on_context_menu)
+        aqt.gui_hooks.operation_did_execute.append(self._on_operation_did_execute)
 
     @cached_property
     def _fetcher(self):
         user_files = os.path.join(os.path.dirname(__file__), "user_files")
         os.makedirs(user_files, exist_ok=True)
         cache_db_name = f"cache.{DictionaryFetcher.CACHE_VERSION}.db"
-        for old_cache_db in glob.glob(os.path.join(user_files, "cache.*.db")):
-            if os.path.basename(old_cache_db) != cache_db_name:
-                try:
-                    os.remove(old_cache_db)
-                except OSError as e:
-                    logger.warn(f"Failed to remove an old cache database {old_cache_db}", exc_info=e)
-        return DictionaryFetcher(cache_database=os.path.join(user_files, cache_db_name))
+        with os.scandir(user_files) as it:
+            for old_cache_db in it:
+                # Also remove WAL files left behind by old databases.
+                name = old_cache_db.name.removesuffix("-wal").removesuffix("-shm")
+                if name != cache_db_name and name.startswith("cache.") and name.endswith(".db"):
+                    try:
+                        os.unlink(old_cache_db.path)
+                    except OSError as e:
+                        logger.warning(f"Failed to remove an old cache database {old_cache_db.path}", exc_info=e)
+        return DictionaryFetcher(cache_database=os.path.join(user_files, cache_db_name), html_parser=self._config.html_parser)
+
+    @cached_property
+    def _formatter(self) -> NoteFormatter:
+        return NoteFormatter(self._fetcher, pronounciation_type=self._config.pronounciation_type)
+
+    def _validate_config(self):
+        concurrency = self._config.concurrency
+        # bool is an int too, but surely not what was meant.
+        if not isinstance(concurrency, int) or isinstance(concurrency, bool) or concurrency < 1:
+            default_concurrency = PluginOptions().concurrency
+            aqt.utils.show_warning(f"Invalid concurrency {concurrency!r}, expected a positive integer; using {default_concurrency}")
+            self._config.concurrency = default_concurrency
+        html_parser = self._config.html_parser
+        # An unavailable tree builder would only show up later, as a failure to fetch every entry.
+        if not isinstance(html_parser, str) or builder_registry.lookup(html_parser) is None:
+            default_html_parser = PluginOptions().html_parser
+            aqt.utils.show_warning(f"HTML parser {html_parser!r} is not available; using {default_html_parser}")
+            self._config.html_parser = default_html_parser
+
+    # Create the shared fetcher and formatter on the main thread, so that operation workers never race to initialize them.
+    def _init_shared_state(self) -> None:
+        # Reading the cached properties is what creates them.
+        self._fetcher
+        self._formatter
 
     def _reset_config(self):
         self._config = PluginOptions()
         aqt.mw.addonManager.writeConfig(__name__, self._config.to_dict())
 
-    def _find_note_type(self, note: Note) -> Optional[NoteType]:
-        if self._config.id_field in note:
-            return NoteType.ENTRY
-        elif self._config.cloze_ids_field in note:
-            return NoteType.CLOZE
+    @contextmanager
+    def _entry_lock(self, key: Union[EntryId, str]):
+        # Serializes concurrent requests for the same entry, so that only the first one hits the network.
+        with self._entry_locks_lock:
+            lock = self._entry_locks.get(key)
+            if lock is None:
+                lock = Lock()
+                self._entry_locks[key] = lock
+        with lock:
+            yield
+
+    def _on_operation_did_execute(self, changes: OpChanges, _handler: Optional[object]):
+        if changes.notetype:
+            self._notetype_cache.clear()
+
+    def _find_notetype_info(self, notetype: NotetypeDict) -> Optional[NotetypeInfo]:
+        model_id: NotetypeId = notetype["id"]
+        try:
+            return self._notetype_cache[model_id]
+        except KeyError:
+            pass
+        config = self._config
+        field_names = {field["name"] for field in notetype["flds"]}
+        info: Optional[NotetypeInfo]
+        if config.id_field in field_names:
+            info = NotetypeInfo(
+                type=NoteType.ENTRY,
+                fields=frozenset((config.word_field, config.definition_field, config.extra_field)) & field_names,
+            )
+        elif config.cloze_ids_field in field_names:
+            info = NotetypeInfo(
+                type=NoteType.CLOZE,
+                fields=frozenset((config.cloze_text_field, config.cloze_extra_field)) & field_names,
+            )
         else:
-            return None
+            info = None
+        self._notetype_cache[model_id] = info
+        return info
+
+    def _find_note_info(self, note: Note) -> Optional[NotetypeInfo]:
+        notetype = note.note_type()
+        assert notetype is not None
+        return self._find_notetype_info(notetype)
+
+    def _find_note_type(self, note: Note) -> Optional[NoteType]:
+        info = self._find_note_info(note)
+        return None if info is None else info.type
+
+    def _get_note_info(self, note: Note) -> NotetypeInfo:
+        info = self._find_note_info(note)
+        if info is None:
+            raise RuntimeError("Unknown note type")
+        return info
 
     def _get_note_type(self, note: Note) -> NoteType:
-        note_type = self._find_note_type(note)
-        if note_type is None:
+        return self._get_note_info(note).type
+
+    def _get_model_info(self, col: Collection, model_id: NotetypeId) -> NotetypeInfo:
+        notetype = col.models.get(model_id)
+        assert notetype is not None
+        info = self._find_notetype_info(notetype)
+        if info is None:
             raise RuntimeError("Unknown note type")
-        return note_type
+        return info
+
+    def _get_model_type(self, col: Collection, model_id: NotetypeId) -> NoteType:
+        return self._get_model_info(col, model_id).type
 
     def _on_context_menu(self, editor_webview: EditorWebView, menu: QMenu):
         editor = editor_webview.editor
@@ -151,29 +308,61 @@ class Plugin:
         action = menu.addAction(_("Verify all the media"))
         qconnect(action.triggered, lambda: self._verify_media_model(editor))
 
-    def _fetch_entry_note(self, col: Collection, note: Note) -> AnkiWordNote:
-        raw_id = note[self._config.id_field]
+    def _key_field(self, type: NoteType) -> str:
+        if type == NoteType.ENTRY:
+            return self._config.id_field
+        elif type == NoteType.CLOZE:
+            return self._config.cloze_ids_field
+        else:
+            raise RuntimeError("Impossible NoteType")
 
-        with self._fetcher_lock:
-            formatter = NoteFormatter(self._fetcher, pronounciation_type=self._config.pronounciation_type)
-            refs = parse_any_ref(self._fetcher, raw_id)
-            if len(refs) == 0:
-                raise AnkiEntryNotFound()
+    # Groups the notes of a model by their key field, reading it directly instead of loading each note separately.
+    def _model_key_note_ids(self, col: Collection, model_id: NotetypeId, type: NoteType) -> dict[str, list[NoteId]]:
+        notetype = col.models.get(model_id)
+        assert notetype is not None
+        field_ord, _field = col.models.field_map(notetype)[self._key_field(type)]
+        assert col.db is not None
+        key_note_ids: dict[str, list[NoteId]] = {}
+        for note_id, flds in col.db.execute("SELECT id, flds FROM notes WHERE mid = ?", model_id):
+            key_note_ids.setdefault(split_fields(flds)[field_ord], []).append(NoteId(note_id))
+        return key_note_ids
+
+    def _model_key_values(self, col: Collection, model_id: NotetypeId, type: NoteType) -> list[str]:
+        # Notes often share entries; each distinct value needs to be processed only once.
+        return list(self._model_key_note_ids(col, model_id, type))
+
+    def _map_media(self, f: Callable[[MediaPath], R], media: dict[MediaName, MediaPath], *, concurrent_media: bool = True) -> dict[MediaName, R]:
+        # Mass operations run this from their own workers; extra threads would each open their own cache connection.
+        if not concurrent_media or len(media) <= 1:
+            return {name: f(path) for name, path in media.items()}
+        with ThreadPoolExecutor(max_workers=MEDIA_WORKERS) as executor:
+            return dict(zip(media.keys(), executor.map(f, media.values())))
+
+    def _fetch_entry_note(self, col: Collection, raw_id: str, *, existing_media: Optional[set[MediaName]] = None, load_media: bool = True, concurrent_media: bool = True) -> AnkiWordNote:
+        refs = parse_any_ref(self._fetcher, raw_id)
+        if len(refs) == 0:
+            raise AnkiEntryNotFound()
+        # Different spellings of the same reference share the lock.
+        with self._entry_lock(refs[0].id):
             try:
-                word_note = formatter.entry_to_note(refs[0])
+                word_note = self._formatter.entry_to_note(refs[0])
             except EntryNotFound:
                 raise AnkiEntryNotFound()
 
-            media_data: dict[MediaName, bytes] = {}
-            for name, path in word_note.media.items():
-                if not col.media.have(name):
-                    file_data = self._fetcher.get_media_data(path)
-                    media_data[name] = file_data
-            return AnkiWordNote(**word_note.__dict__, media_data=media_data)
-
-    def _update_entry_note(self, col: Collection, note: Note, *, fields: Optional[set[str]] = None, on_fetch: Optional[Callable[[], None]] = None):
-        word_note = self._fetch_entry_note(col, note)
-
+            if existing_media is None:
+                missing_media = {name: path for name, path in word_note.media.items() if not col.media.have(name)}
+            else:
+                missing_media = {name: path for name, path in word_note.media.items() if name not in existing_media}
+            if load_media:
+                media_data = self._map_media(self._fetcher.get_media_data, missing_media, concurrent_media=concurrent_media)
+            else:
+                # Only make sure that the media are cached, without keeping their contents around.
+                self._map_media(self._fetcher.cache_media, missing_media, concurrent_media=concurrent_media)
+                media_data = {}
+            word_note_fields = {word_note_field.name: getattr(word_note, word_note_field.name) for word_note_field in dataclasses.fields(word_note)}
+            return AnkiWordNote(**word_note_fields, media_data=media_data)
+
+    def _apply_entry_note(self, col: Collection, note: Note, word_note: AnkiWordNote, *, fill_fields: frozenset[str], on_fetch: Optional[Callable[[], None]] = None):
         for name, data in word_note.media_data.items():
             new_name = col.media.write_data(name, data)
             assert name == new_name
@@ -181,52 +370,58 @@ class Plugin:
         if on_fetch:
             on_fetch()
 
-        note[self._config.id_field] = f'<a href="{build_entry_url(word_note.ref)}">{ref_to_string(word_note.ref)}</a>'
-        if self._config.word_field in note and (fields is None or self._config.word_field in fields):
-            note[self._config.word_field] = word_note.word
-        if self._config.definition_field in note and (fields is None or self._config.definition_field in fields):
-            note[self._config.definition_field] = word_note.definition
-        if self._config.extra_field in note and (fields is None or self._config.extra_field in fields):
-            note[self._config.extra_field] = word_note.extra
-
-    def _fetch_cloze_note(self, col: Collection, note: Note) -> ClozeNote:
-        id_cloze = note[self._config.cloze_ids_field].strip()
+        config = self._config
+        note[config.id_field] = f'<a href="{build_entry_url(word_note.ref)}">{ref_to_string(word_note.ref)}</a>'
+        _fill_fields(note, fill_fields, (
+            (config.word_field, word_note.word),
+            (config.definition_field, word_note.definition),
+            (config.extra_field, word_note.extra),
+        ))
 
-        with self._fetcher_lock:
-            formatter = NoteFormatter(self._fetcher, pronounciation_type=self._config.pronounciation_type)
-            return formatter.cloze_to_note(id_cloze)
+    def _fetch_cloze_note(self, col: Collection, raw_ids: str) -> ClozeNote:
+        id_cloze = raw_ids.strip()
 
-    def _update_cloze_note(self, col: Collection, note: Note, *, fields: Optional[set[str]] = None, on_fetch: Optional[Callable[[], None]] = None):
-        cloze_note = self._fetch_cloze_note(col, note)
+        # A cloze spans several entries, so it is locked by its normalized text.
+        with self._entry_lock(id_cloze):
+            return self._formatter.cloze_to_note(id_cloze)
 
+    def _apply_cloze_note(self, col: Collection, note: Note, cloze_note: ClozeNote, *, fill_fields: frozenset[str], on_fetch: Optional[Callable[[], None]] = None):
         if on_fetch:
             on_fetch()
 
-        note[self._config.cloze_ids_field] = cloze_note.inline_ids
-        if self._config.cloze_text_field in note and (fields is None or self._config.cloze_text_field in fields):
-            note[self._config.cloze_text_field] = cloze_note.cloze
-        if self._config.cloze_extra_field in note and (fields is None or self._config.cloze_extra_field in fields):
-            note[self._config.cloze_extra_field] = cloze_note.extra
+        config = self._config
+        note[config.cloze_ids_field] = cloze_note.inline_ids
+        _fill_fields(note, fill_fields, (
+            (config.cloze_text_field, cloze_note.cloze),
+            (config.cloze_extra_field, cloze_note.extra),
+        ))
 
-    def _fetch_note(self, col: Collection, note: Note, type: NoteType):
+    def _fetch_note(self, col: Collection, raw_key: str, type: NoteType, *, existing_media: Optional[set[MediaName]] = None, load_media: bool = True, concurrent_media: bool = True) -> Union[AnkiWordNote, ClozeNote]:
         if type == NoteType.ENTRY:
-            self._fetch_entry_note(col, note)
+            return self._fetch_entry_note(col, raw_key, existing_media=existing_media, load_media=load_media, concurrent_media=concurrent_media)
         elif type == NoteType.CLOZE:
-            self._fetch_cloze_note(col, note)
+            return self._fetch_cloze_note(col, raw_key)
         else:
             raise RuntimeError("Impossible NoteType")
 
-    def _update_note(self, col: Collection, note: Note, type: NoteType, *, fields: Optional[set[str]] = None, on_fetch: Optional[Callable[[], None]] = None):
+    def _apply_note(self, col: Collection, note: Note, type: NoteType, fetched: Union[AnkiWordNote, ClozeNote], *, fill_fields: frozenset[str], on_fetch: Optional[Callable[[], None]] = None):
         if type == NoteType.ENTRY:
-            self._update_entry_note(col, note, fields=fields, on_fetch=on_fetch)
+            assert isinstance(fetched, AnkiWordNote)
+            self._apply_entry_note(col, note, fetched, fill_fields=fill_fields, on_fetch=on_fetch)
         elif type == NoteType.CLOZE:
-            self._update_cloze_note(col, note, fields=fields, on_fetch=on_fetch)
+            assert isinstance(fetched, ClozeNote)
+            self._apply_cloze_note(col, note, fetched, fill_fields=fill_fields, on_fetch=on_fetch)
         else:
             raise RuntimeError("Impossible NoteType")
 
+    def _update_note(self, col: Collection, note: Note, *, fields: Optional[frozenset[str]] = None, on_fetch: Optional[Callable[[], None]] = None):
+        info = self._get_note_info(note)
+        fetched = self._fetch_note(col, note[self._key_field(info.type)], info.type)
+        self._apply_note(col, note, info.type, fetched, fill_fields=_fields_to_fill(info, fields), on_fetch=on_fetch)
+
     def _fetch_single_note_proc(self, col: Collection, note: Note):
         note_type = self._get_note_type(note)
-        self._fetch_note(col, note, note_type)
+        self._fetch_note(col, note[self._key_field(note_type)], note_type, load_media=False)
 
     def _fetch_model_notes_proc(self, col: Collection, model_id: NotetypeId):
         assert aqt.mw is not None
@@ -237,26 +432,22 @@ class Plugin:
                 label=_("Searching for model notes"),
             )
         )
-        all_nids = col.models.nids(model_id)
-        total = len(all_nids)
-        note_type = None
-        for i, note_id in enumerate(all_nids):
-            note = col.get_note(note_id)
-            if note_type is None:
-                note_type = self._get_note_type(note)
-            mw.taskman.run_on_main(
-                lambda: mw.progress.update(
-                    label=_("Fetching note {} of {}").format(i + 1, total),
-                    value=i,
-                    max=total,
-                )
-            )
-            try:
-                self._fetch_note(col, note, note_type)
-            except AnkiEntryNotFound:
-                pass
+        note_type = self._get_model_type(col, model_id)
+        raw_keys = self._model_key_values(col, model_id, note_type)
+        total = len(raw_keys)
+        report_progress = _make_progress_reporter(mw, _("Fetching entry {} of {}"), total)
+        # Nothing is written into the media folder here, so a single listing suffices.
+        existing_media = set(os.listdir(col.media.dir()))
+        # The collection is only touched for reading here, so workers may fetch in parallel.
+        with _map_concurrently(lambda raw_key: self._fetch_note(col, raw_key, note_type, existing_media=existing_media, load_media=False, concurrent_media=False), raw_keys, max_workers=self._config.concurrency) as fetched_notes:
+            for i, (_raw_key, future) in enumerate(fetched_notes):
+                report_progress(i)
+                try:
+                    future.result()
+                except AnkiEntryNotFound:
+                    pass
 
-    def _update_single_note_proc(self, col: Collection, note: Note, fields: Optional[set[str]] = None) -> OpChanges:
+    def _update_single_note_proc(self, col: Collection, note: Note, fields: Optional[frozenset[str]] = None) -> OpChanges:
         assert aqt.mw is not None
         mw = aqt.mw
 
@@ -269,15 +460,15 @@ class Plugin:
         def on_fetch():
             nonlocal pos
             pos = col.add_custom_undo_entry(_("thai-language.com: Update the note"))
-        self._update_note(col, note, self._get_note_type(note), fields=fields, on_fetch=on_fetch)
+        self._update_note(col, note, fields=fields, on_fetch=on_fetch)
         assert pos is not None
         col.update_note(note)
         return col.merge_undo_entries(pos)
 
-    def _update_single_new_note_proc(self, col: Collection, note: Note, fields: Optional[set[str]] = None):
-        self._update_note(col, note, self._get_note_type(note), fields=fields)
+    def _update_single_new_note_proc(self, col: Collection, note: Note, fields: Optional[frozenset[str]] = None):
+        self._update_note(col, note, fields=fields)
 
-    def _update_model_notes_proc(self, col: Collection, model_id: NotetypeId, fields: Optional[set[str]] = None) -> OpChanges:
+    def _update_model_notes_proc(self, col: Collection, model_id: NotetypeId, fields: Optional[frozenset[str]] = None) -> OpChanges:
         assert aqt.mw is not None
         mw = aqt.mw
 
@@ -287,52 +478,76 @@ class Plugin:
             )
         )
         pos = col.add_custom_undo_entry(_("thai-language.com: Update the model notes"))
-        all_nids = col.models.nids(model_id)
-        total = len(all_nids)
+        info = self._get_model_info(col, model_id)
+        note_type = info.type
+        # Fetch each distinct entry once, even if several notes share it.
+        key_note_ids = self._model_key_note_ids(col, model_id, note_type)
+        total = sum(len(note_ids) for note_ids in key_note_ids.values())
+        report_progress = _make_progress_reporter(mw, _("Updating note {} of {}"), total)
         processed_notes = []
-        note_type = None
-        for i, note_id in enumerate(all_nids):
-            note = col.get_note(note_id)
-            if note_type is None:
-                note_type = self._get_note_type(note)
-            mw.taskman.run_on_main(
-                lambda: mw.progress.update(
-                    label=_("Updating note {} of {}").format(i + 1, total),
-                    value=i,
-                    max=total,
-                )
-            )
-            try:
-                self._update_note(col, note, note_type, fields=fields)
-                processed_notes.append(note)
-            except AnkiEntryNotFound:
-                pass
-        col.update_notes(processed_notes)
-        return col.merge_undo_entries(pos)
-
-    def _verify_entry_media(self, col: Collection, note: Note):
-        raw_id = note[self._config.id_field]
-
-        with self._fetcher_lock:
-            formatter = NoteFormatter(self._fetcher, pronounciation_type=self._config.pronounciation_type)
-            refs = parse_any_ref(self._fetcher, raw_id)
-            if len(refs) == 0:
-                raise AnkiEntryNotFound()
+        fill_fields = _fields_to_fill(info, fields)
+        get_note = col.get_note
+        apply_note = self._apply_note
+        i = 0
+        try:
+            # Only fetching happens in the workers; the notes are loaded and written from this thread as their entries arrive.
+            with _map_concurrently(lambda raw_key: self._fetch_note(col, raw_key, note_type, concurrent_media=False), key_note_ids.keys(), max_workers=self._config.concurrency) as fetched_notes:
+                for raw_key, future in fetched_notes:
+                    try:
+                        fetched = future.result()
+                    except AnkiEntryNotFound:
+                        fetched = None
+                    for note_id in key_note_ids[raw_key]:
+                        report_progress(i)
+                        i += 1
+                        if fetched is not None:
+                            note = get_note(note_id)
+                            apply_note(col, note, note_type, fetched, fill_fields=fill_fields)
+                            processed_notes.append(note)
+                    # Write the notes as we go; everything is still merged into a single undo entry below.
+                    if len(processed_notes) >= NOTES_CHUNK_SIZE:
+                        col.update_notes(processed_notes)
+                        processed_notes.clear()
+            if len(processed_notes) > 0:
+                col.update_notes(processed_notes)
+        finally:
+            # Keep whatever has been written undoable as a single entry, even if we stopped midway.
+            changes = col.merge_undo_entries(pos)
+        return changes
+
+    def _fetch_verified_entry_media(self, col: Collection, raw_id: str, *, concurrent_media: bool = True) -> dict[MediaName, bytes]:
+        refs = parse_any_ref(self._fetcher, raw_id)
+        if len(refs) == 0:
+            raise AnkiEntryNotFound()
+        with self._entry_lock(refs[0].id):
             try:
-                word_note = formatter.entry_to_note(refs[0])
+                word_note = self._formatter.entry_to_note(refs[0])
             except EntryNotFound:
                 raise AnkiEntryNotFound()
 
-            for name, path in word_note.media.items():
-                file_data = self._fetcher.get_media_data(path, verify=True)
-                if col.media.have(name):
-                    col.media.trash_files([name])
-                new_name = col.media.write_data(name, file_data)
-                assert name == new_name
+            return self._map_media(lambda path: self._fetcher.get_media_data(path, verify=True), word_note.media, concurrent_media=concurrent_media)
+
+    def _write_verified_media(self, col: Collection, media_data: dict[MediaName, bytes], *, existing_media: Optional[set[MediaName]] = None):
+        for name, file_data in media_data.items():
+            if existing_media is None:
+                have = col.media.have(name)
+            else:
+                have = name in existing_media
+            if have:
+                col.media.trash_files([name])
+            new_name = col.media.write_data(name, file_data)
+            assert name == new_name
+            if existing_media is not None:
+                existing_media.add(name)
 
-    def _verify_media_note(self, col: Collection, note: Note, type: NoteType):
+    def _fetch_verified_media_note(self, col: Collection, raw_key: str, type: NoteType, *, concurrent_media: bool = True) -> dict[MediaName, bytes]:
         if type == NoteType.ENTRY:
-            self._verify_entry_media(col, note)
+            return self._fetch_verified_entry_media(col, raw_key, concurrent_media=concurrent_media)
+        else:
+            return {}
+
+    def _verify_media_note(self, col: Collection, note: Note, type: NoteType):
+        self._write_verified_media(col, self._fetch_verified_media_note(col, note[self._key_field(type)], type))
 
     def _verify_media_proc(self, col: Collection, note: Note):
         assert aqt.mw is not None
@@ -349,24 +564,19 @@ class Plugin:
                 label=_("Searching for model notes"),
             )
         )
-        all_nids = col.models.nids(model_id)
-        total = len(all_nids)
-        note_type = None
-        for i, note_id in enumerate(all_nids):
-            note = col.get_note(note_id)
-            if note_type is None:
-                note_type = self._get_note_type(note)
-            mw.taskman.run_on_main(
-                lambda: mw.progress.update(
-                    label=_("Verifying note {} of {}").format(i + 1, total),
-                    value=i,
-                    max=total,
-                )
-            )
-            try:
-                self._verify_media_note(col, note, note_type)
-            except AnkiEntryNotFound:
-                pass
+        note_type = self._get_model_type(col, model_id)
+        raw_keys = self._model_key_values(col, model_id, note_type)
+        total = len(raw_keys)
+        report_progress = _make_progress_reporter(mw, _("Verifying entry {} of {}"), total)
+        existing_media = set(os.listdir(col.media.dir()))
+        with _map_concurrently(lambda raw_key: self._fetch_verified_media_note(col, raw_key, note_type, concurrent_media=False), raw_keys, max_workers=self._config.concurrency) as fetched_notes:
+            for i, (_raw_key, future) in enumerate(fetched_notes):
+                report_progress(i)
+                try:
+                    media_data = future.result()
+                except AnkiEntryNotFound:
+                    continue
+                self._write_verified_media(col, media_data, existing_media=existing_media)
 
     def _fetch(self, editor: Editor):
         assert editor.note is not None
@@ -396,7 +606,7 @@ class Plugin:
             .failure(lambda e: _handle_failure(editor, e)) \
             .run_in_background()
 
-    def _update(self, editor: Editor, fields: Optional[set[str]] = None):
+    def _update(self, editor: Editor, fields: Optional[frozenset[str]] = None):
         assert editor.note is not None
         note = editor.note
         # Ugh.
@@ -419,7 +629,7 @@ class Plugin:
                 .failure(lambda e: _handle_failure(editor, e)) \
                 .run_in_background()
 
-    def _update_model(self, editor: Editor, fields: Optional[set[str]] = None):
+    def _update_model(self, editor: Editor, fields: Optional[frozenset[str]] = None):
         if not aqt.utils.askUser(
             text=_("Are you sure you want to perform a mass operation?"),
             parent=editor.parentWindow,
@@ -443,14 +653,14 @@ class Plugin:
             return
         assert editor.note is not None
         field = editor.note.keys()[editor.currentField]
-        self._update(editor, set([field]))
+        self._update(editor, frozenset([field]))
 
     def _update_current_model(self, editor: Editor):
         if editor.currentField is None:
             return
         assert editor.note is not None
         field = editor.note.keys()[editor.currentField]
-        self._update_model(editor, set([field]))
+        self._update_model(editor, frozenset([field]))
 
     def _verify_media(self, editor: Editor):
         assert editor.note is not None
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+import unittest
+
+from thai_language.types import *
+from thai_language.fetch import DictionaryFetcher
+
+
+def _entry(id: EntryId, word: str, pronounciation: str, components: ComponentsList) -> DictionaryEntry:
+    return DictionaryEntry(
+        id=id,
+        entry=word,
+        pronounciations={"Paiboon": pronounciation},
+        definitions={
+            "1": EntryDefinition(id="1", definition="", classes=[], super_entry="ไปมา", components=components),
+        },
+    )
+
+
+# Serves entries from memory instead of the site.
+class _StubFetcher(DictionaryFetcher):
+    def __init__(self, entries: dict[EntryId, DictionaryEntry]):
+        super().__init__()
+        self.entries = entries
+        self.fetched: list[EntryId] = []
+
+    def _get_entry(self, id: EntryId) -> DictionaryEntry:
+        self.fetched.append(id)
+        return DictionaryEntry.from_dict(self.entries[id].to_dict())
+
+
+class MutualSuperEntriesTest(unittest.TestCase):
+    # ไป and มา both list ไปมา as a super entry, which refers back to each of them.
+    def test_fetch_mutually_referencing_entries(self):
+        fetcher = _StubFetcher({
+            10: _entry(10, "ไป", "bpai", [SELF_REFERENCE, EntryRef(11)]),
+            11: _entry(11, "มา", "maa", [EntryRef(10), SELF_REFERENCE]),
+        })
+
+        entry = fetcher.get_entry(10)
+
+        self.assertEqual(entry.id, 10)
+        self.assertEqual(fetcher.fetched, [10, 11])
+        self.assertEqual(fetcher.get_super_entry(entry, "1").pronounciations, {"Paiboon": "bpai maa"})
+        self.assertCountEqual(fetcher.lookup_word("ไปมา"), [EntryRef(10, "1"), EntryRef(11, "1")])
+
+
+if __name__ == "__main__":
+    unittest.main()
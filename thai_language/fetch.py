@@ -1,29 +1,60 @@
-from copy import copy
+from contextlib import contextmanager
+from functools import lru_cache
 import re
 import logging
 from itertools import islice
-from typing import Any, Generator, Optional
+from typing import Any, Generator, Iterator, Optional
 from urllib.parse import urljoin
 import hashlib
 import json
 import sqlite3
+import threading
 import unicodedata
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup, NavigableString, Tag
+# Anki bundles orjson, but don't require it.
+try:
+    import orjson
 
-from .utils import norecurse
+    def _dump_json(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+    def _load_json(data: bytes) -> Any:
+        return orjson.loads(data)
+except ImportError:
+    def _dump_json(obj: Any) -> bytes:
+        return json.dumps(obj).encode()
+
+    def _load_json(data: bytes) -> Any:
+        return json.loads(data)
+
+from .utils import LRUCache, norecurse
 from .types import *
 
 
 logger = logging.getLogger(__name__)
 
 BASE_URL = "http://www.thai-language.com"
+# Notes are fetched by several workers, each of which may download several media files at once.
+HTTP_POOL_SIZE = 32
+# The site sometimes fails under load; retry instead of failing the whole note.
+HTTP_RETRIES = Retry(total=3, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504))
+MEDIA_CHUNK_SIZE = 65536
+CACHED_STATEMENTS = 512
 
 
 class EntryNotFound(Exception):
     pass
 
 
+# The same words and pronounciations are normalized over and over.
+@lru_cache(maxsize=65536)
+def _nfc(s: str) -> str:
+    return unicodedata.normalize("NFC", s)
+
+
 def _find_single(tag: Tag, *args, **kwargs) -> Optional[Tag]:
     rs = tag.find_all( *args, **kwargs)
     if len(rs) == 0:
@@ -51,20 +82,37 @@ def _get_first(tag: Tag, *args, **kwargs) -> Tag:
 
 _ENTRY_URL_REGEX = re.compile(r"(?:(?:(?:https?://)?(?:www\.)?thai-language\.com)?/id/(?P<id>[0-9]+))?(?:#def(?P<def>[0-9]+[^?]*))?")
 
-def parse_entry_url(url: str, self_id: Optional[EntryId] = None) -> Optional[EntryRef]:
+def _is_ascii_number(s: str) -> bool:
+    return s.isascii() and s.isdigit()
+
+# Returns the raw entry and definition ids of an entry URL.
+def _split_entry_url(url: str) -> Optional[tuple[Optional[str], Optional[str]]]:
+    # Links on the site are nearly always relative; check for those without running the regex.
+    path, hash, fragment = url.partition("#")
+    if (path == "" or path.startswith("/id/") and _is_ascii_number(path[4:])) \
+            and (hash == "" or fragment.startswith("def") and _is_ascii_number(fragment[3:4]) and "?" not in fragment):
+        return path[4:] or None, fragment[3:] or None
     m = _ENTRY_URL_REGEX.fullmatch(url)
     if m is None:
         return None
+    return m["id"], m["def"]
+
+@lru_cache(maxsize=4096)
+def parse_entry_url(url: str, self_id: Optional[EntryId] = None) -> Optional[EntryRef]:
+    parts = _split_entry_url(url)
+    if parts is None:
+        return None
     else:
-        if m["id"] is None:
+        raw_id, defn = parts
+        if raw_id is None:
             if self_id is None:
                 return None
             id = self_id
         else:
-            id = int(m["id"])
+            id = int(raw_id)
         return EntryRef(
             id=id,
-            definition=m["def"],
+            definition=defn,
         )
 
 def build_entry_url(ref: EntryRef) -> str:
@@ -75,11 +123,7 @@ def build_entry_url(ref: EntryRef) -> str:
         return url + f"#def{ref.definition}"
 
 
-def _parse_entry_header(entry_tag: Tag):
-    # Get the first table.
-    header = entry_tag.find("table", width="100%", recursive=False)
-    if not isinstance(header, Tag):
-        raise RuntimeError("Header not found")
+def _parse_entry_header(header: Tag):
     try:
         # Sometimes there might be several spellings. In this case, pick the first one.
         # For example: http://thai-language.com/id/131401
@@ -109,8 +153,7 @@ def _is_pronounciation_table(tag: Tag):
     return t.text == "pronunciation guide"
 
 
-def _parse_entry_pronounciations(entry_tag: Tag):
-    pronounciations_tag = _get_single(entry_tag, _is_pronounciation_table, recursive=False)
+def _parse_entry_pronounciations(pronounciations_tag: Tag):
     try:
         pronounciations: dict[str, str] = {}
         for pr in islice(pronounciations_tag.children, 1, None):
@@ -127,12 +170,14 @@ def _parse_entry_pronounciations(entry_tag: Tag):
         raise RuntimeError(f"Failed to parse pronounciations: {pronounciations_tag}") from e
 
 
+_SEPARATOR_STYLE_REGEX = re.compile(r"background-color: *black")
+
 def _is_definitions_table(tag: Tag):
     if tag.name != "table":
         return False
     # We look for the horizontal line, which is implemented as a row with
     # back background color and a single cell.
-    separator_rows = tag.find_all("tr", style=re.compile("background-color: *black"))
+    separator_rows = tag.find_all("tr", style=_SEPARATOR_STYLE_REGEX)
     if len(separator_rows) > 1:
         raise RuntimeError("Unexpected several separator rows")
     return len(separator_rows) > 0
@@ -172,7 +217,8 @@ def _parse_definition_header(tag: Tag, id: EntryId, entry_word: str):
         if m is None:
             raise RuntimeError(f"Invalid definition header text: {classes_tag.text}")
         classes = m[1].split(", ")
-    common_tag = _find_single(cell, "img", alt="common Thai word")
+    # Only the presence matters here.
+    common_tag = cell.find("img", alt="common Thai word")
 
     # Sometimes there might be several spellings. In this case, pick the first one.
     # For example: http://thai-language.com/id/131401
@@ -235,27 +281,24 @@ def _parse_categories_field(rows: list[list[Tag]]):
     }
 
 
-def _is_entry_link(tag: Tag):
-    # "ttid" hints at a subcomponent; ignore these.
-    if tag.name != "a" or "href" not in tag.attrs or "ttid" in tag.attrs:
-        return False
-    m = _ENTRY_URL_REGEX.fullmatch(tag.attrs["href"])
-    return m is not None
-
-
 def _parse_entry_list_field(rows: list[list[Tag]], id: EntryId) -> list[EntryRef]:
     components: list[EntryRef] = []
     for row in rows:
-        link_tag = None
+        ref: Optional[EntryRef] = None
         for cell in row:
-            link_tag = _find_single(cell, _is_entry_link)
-            if link_tag is not None:
+            # "ttid" hints at a subcomponent; ignore these.
+            cell_refs = [
+                cell_ref
+                for link_tag in cell.find_all("a", href=True)
+                if "ttid" not in link_tag.attrs and (cell_ref := parse_entry_url(link_tag.attrs["href"], id)) is not None
+            ]
+            if len(cell_refs) > 1:
+                raise RuntimeError("More than one entry link found in a cell")
+            if len(cell_refs) == 1:
+                ref = cell_refs[0]
                 break
-        if link_tag is None:
-            raise RuntimeError("Failed to fink an entry link in rows")
-        ref = parse_entry_url(link_tag.attrs["href"], id)
         if ref is None:
-            raise RuntimeError("Failed to parse an entry URL: {link}")
+            raise RuntimeError("Failed to find an entry link in rows")
         components.append(ref)
 
     return components
@@ -264,18 +307,23 @@ def _parse_entry_list_field(rows: list[list[Tag]], id: EntryId) -> list[EntryRef
 def _parse_definitions_table(table: Tag, id: EntryId, entry_word: str) -> Generator[EntryDefinition, None, None]:
     iterator = iter(table.children)
 
+    # Every row is inspected several times, so its cells and kind are computed once when we reach it.
     current: Optional[Tag] = None
+    current_cells: list[Tag] = []
+    current_is_separator = False
     def next_row():
-        nonlocal current
+        nonlocal current, current_cells, current_is_separator
         while row := next(iterator, None):
             if isinstance(row, Tag):
                 current = row
+                current_cells = [child for child in row.children if isinstance(child, Tag)]
+                current_is_separator = _is_definitions_separator_row(row)
                 return
         current = None
     next_row()
 
     while current is not None:
-        if _is_definitions_separator_row(current):
+        if current_is_separator:
             next_row()
             continue
 
@@ -287,14 +335,14 @@ def _parse_definitions_table(table: Tag, id: EntryId, entry_word: str) -> Genera
                 next_row()
             else:
                 # Special notes section; skip
-                while current is not None and not _is_definitions_separator_row(current):
+                while current is not None and not current_is_separator:
                     next_row()
                 continue
         except Exception as e:
             raise RuntimeError(f"Failed to parse definition header") from e
 
-        while current is not None and not _is_definitions_separator_row(current):
-            header_cells = [child for child in current.children if isinstance(child, Tag)]
+        while current is not None and not current_is_separator:
+            header_cells = current_cells
             field_header = header_cells[0]
             field_name = field_header.text
             field_rows_count = int(field_header.attrs.get("rowspan", 1))
@@ -303,7 +351,7 @@ def _parse_definitions_table(table: Tag, id: EntryId, entry_word: str) -> Genera
             for _ in range(field_rows_count - 1):
                 if current is None:
                     break
-                field_rows.append([child for child in current.children if isinstance(child, Tag)])
+                field_rows.append(current_cells)
                 next_row()
 
             try:
@@ -332,8 +380,33 @@ def _parse_definitions_table(table: Tag, id: EntryId, entry_word: str) -> Genera
         next_row()
 
 
-def _parse_entry_definitions(entry_tag: Tag, id: EntryId, entry_word: str):
-    definitions_tag = _get_single(entry_tag, _is_definitions_table, recursive=False)
+# Finds the header, pronounciations and definitions tables in a single pass over the entry.
+def _classify_tables(entry_tag: Tag) -> tuple[Tag, Tag, Tag]:
+    header: Optional[Tag] = None
+    pronounciations: Optional[Tag] = None
+    definitions: Optional[Tag] = None
+    for table in entry_tag.find_all("table", recursive=False):
+        # The header is the first full-width table.
+        if header is None and table.attrs.get("width") == "100%":
+            header = table
+        if _is_pronounciation_table(table):
+            if pronounciations is not None:
+                raise RuntimeError("More than one pronounciations table found")
+            pronounciations = table
+        if _is_definitions_table(table):
+            if definitions is not None:
+                raise RuntimeError("More than one definitions table found")
+            definitions = table
+    if header is None:
+        raise RuntimeError("Header not found")
+    if pronounciations is None:
+        raise RuntimeError("Pronounciations table not found")
+    if definitions is None:
+        raise RuntimeError("Definitions table not found")
+    return header, pronounciations, definitions
+
+
+def _parse_entry_definitions(definitions_tag: Tag, id: EntryId, entry_word: str):
     try:
         defns = {entry.id: entry for entry in _parse_definitions_table(definitions_tag, id, entry_word)}
         return {
@@ -369,21 +442,42 @@ FETCHER_SETTINGS = {
 
 class DictionaryFetcher:
     _session: requests.Session
-    _cache_db: sqlite3.Connection
+    _session_lock: threading.Lock
+    _cache_database: str
+    _main_cache_db: sqlite3.Connection
+    _cache_local: threading.local
+    _cache_write_lock: threading.Lock
+    # Decoded entries, so that popular components don't hit the database every time.
+    _entry_cache: LRUCache[EntryId, DictionaryEntry]
+    _html_parser: str
     _session_initialized = False
 
-    CACHE_VERSION = 4
+    CACHE_VERSION = 5
+    ENTRY_CACHE_SIZE = 4096
 
-    def __init__(self, *, cache_database: Optional[str]=None):
+    def __init__(self, *, cache_database: Optional[str]=None, html_parser: Optional[str]=None):
         self._session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE, max_retries=HTTP_RETRIES)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._session_lock = threading.Lock()
+        self._cache_write_lock = threading.Lock()
+        self._entry_cache = LRUCache(self.ENTRY_CACHE_SIZE)
+        # The page parsers are written against the tree built by html.parser; other parsers need to be opted in.
+        if html_parser is None:
+            html_parser = "html.parser"
+        self._html_parser = html_parser
         if cache_database is None:
             cache_database = ":memory:"
-        self._cache_db = sqlite3.connect(cache_database, isolation_level=None, check_same_thread=False)
+        self._cache_database = cache_database
+        self._cache_local = threading.local()
+        self._main_cache_db = self._connect_cache()
+        self._cache_local.connection = self._main_cache_db
 
         self._cache_db.execute("""
             CREATE TABLE IF NOT EXISTS entries (
                 id INTEGER PRIMARY KEY,
-                data TEXT NOT NULL
+                data BLOB NOT NULL
             ) STRICT
         """)
         self._cache_db.execute("""
@@ -414,6 +508,9 @@ class DictionaryFetcher:
         self._cache_db.execute("""
             CREATE INDEX IF NOT EXISTS pronounciations_idx ON pronounciations (pronounciation)
         """)
+        self._cache_db.execute("""
+            CREATE INDEX IF NOT EXISTS redirects_idx ON redirects (entry_id)
+        """)
         self._cache_db.execute("""
             CREATE TABLE IF NOT EXISTS words (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -424,20 +521,62 @@ class DictionaryFetcher:
                 UNIQUE (entry_id, definition_id)
             ) STRICT
         """)
+        self._cache_db.execute("""
+            CREATE INDEX IF NOT EXISTS words_idx ON words (word)
+        """)
 
         self._session_initialized = False
 
+    def _connect_cache(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self._cache_database, isolation_level=None, check_same_thread=False, cached_statements=CACHED_STATEMENTS)
+        # WAL lets readers proceed while another thread writes into the cache.
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA cache_size=-65536")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=268435456")
+        return conn
+
+    @property
+    def _cache_db(self) -> sqlite3.Connection:
+        # Every in-memory database is private to its connection, so it has to be shared.
+        if self._cache_database == ":memory:":
+            return self._main_cache_db
+        conn = getattr(self._cache_local, "connection", None)
+        if conn is None:
+            conn = self._connect_cache()
+            self._cache_local.connection = conn
+        return conn
+
+    # Groups cache writes into a single transaction, so that they are synced to disk once.
+    @contextmanager
+    def _cache_transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._cache_write_lock:
+            db = self._cache_db
+            db.execute("BEGIN")
+            try:
+                yield db
+                db.execute("COMMIT")
+            except BaseException:
+                # A failed COMMIT may leave the transaction open; close it so that the connection stays usable.
+                if db.in_transaction:
+                    db.execute("ROLLBACK")
+                raise
+
     def _ensure_initialized(self):
         if self._session_initialized:
             return
-        # Set the settings.
-        r = self._session.post(
-            urljoin(BASE_URL, "/default.aspx?nav=control"),
-            data=FETCHER_SETTINGS,
-            allow_redirects=False
-        )
-        r.raise_for_status()
-        self._session_initialized = True
+        with self._session_lock:
+            if self._session_initialized:
+                return
+            # Set the settings.
+            r = self._session.post(
+                urljoin(BASE_URL, "/default.aspx?nav=control"),
+                data=FETCHER_SETTINGS,
+                allow_redirects=False
+            )
+            r.raise_for_status()
+            self._session_initialized = True
 
     def _get_super_entry_pronounciations(self, name: str, self_pronounciation: str, components: ComponentsList) -> str:
         pronounciation_parts = []
@@ -450,22 +589,29 @@ class DictionaryFetcher:
         return " ".join(pronounciation_parts)
 
     def get_super_entry(self, entry: DictionaryEntry, defn_id: DefinitionId) -> DictionaryEntry:
+        super_entry = entry._super_entries.get(defn_id)
+        if super_entry is not None:
+            return super_entry
         try:
             defn = entry.definitions[defn_id]
         except KeyError:
             raise EntryNotFound()
         assert defn.super_entry is not None
         assert defn.components is not None
-        new_defn = copy(defn)
-        new_defn.super_entry = None
-        new_defn.components = [EntryRef(entry.id) if comp == SELF_REFERENCE or comp == REPETITION_CHARACTER else comp for comp in defn.components]
+        new_defn = dataclasses.replace(
+            defn,
+            super_entry=None,
+            components=[EntryRef(entry.id) if comp == SELF_REFERENCE or comp == REPETITION_CHARACTER else comp for comp in defn.components],
+        )
         pronounciations = {name: self._get_super_entry_pronounciations(name, pron, defn.components) for name, pron in entry.pronounciations.items()}
-        return DictionaryEntry(
+        super_entry = DictionaryEntry(
             id=entry.id,
             entry=defn.super_entry,
             pronounciations=pronounciations,
             definitions={defn_id: new_defn},
         )
+        entry._super_entries[defn_id] = super_entry
+        return super_entry
 
     @norecurse(getter=lambda _self, entry, defn_id: (entry.id, defn_id))
     def _norecurse_get_super_entry(self, *args, **kwargs):
@@ -481,87 +627,97 @@ class DictionaryFetcher:
                 raise EntryNotFound(f"Dictionary entry {id} does not exist")
             r.raise_for_status()
 
-            # We are forced to; otherwise, we need to bundle html5lib with Anki.
-            soup = BeautifulSoup(r.text, "html.parser")
-            entry_tag = _get_single(soup, "div", id="old-content")
-            link_tag = _get_single(soup, "link", rel="canonical", href=True)
+            # Let the parser decode the page itself; lxml consumes the bytes directly.
+            soup = BeautifulSoup(r.content, self._html_parser, from_encoding=r.encoding)
+            # Both are unique on a valid page; stop looking at the first match instead of walking the whole document.
+            entry_tag = _get_first(soup, "div", id="old-content")
+            link_tag = _get_first(soup, "link", rel="canonical", href=True)
             real_ref = parse_entry_url(link_tag.attrs["href"])
             if real_ref is None:
                 raise RuntimeError("Failed to parse the canonical link")
             data: dict[str, Any] = {
                 "id": real_ref.id,
             }
-            data.update(_parse_entry_header(entry_tag))
-            data.update(_parse_entry_pronounciations(entry_tag))
-            data.update(_parse_entry_definitions(entry_tag, real_ref.id, data["entry"]))
+            header_tag, pronounciations_tag, definitions_tag = _classify_tables(entry_tag)
+            data.update(_parse_entry_header(header_tag))
+            data.update(_parse_entry_pronounciations(pronounciations_tag))
+            data.update(_parse_entry_definitions(definitions_tag, real_ref.id, data["entry"]))
 
             return DictionaryEntry(**data)
         except Exception as e:
             raise RuntimeError(f"Failed to get dictionary entry {id}") from e
 
-    def _cache_entry(self, ref: EntryRef, entry: DictionaryEntry):
-        for type, pronounciation in entry.pronounciations.items():
-            pronounciation = unicodedata.normalize("NFC", pronounciation)
-            try:
-                self._cache_db.execute("INSERT INTO pronounciations (pronounciation, type, entry_id, definition_id) VALUES (?, ?, ?, ?)", (pronounciation, type, ref.id, ref.definition))
-            except Exception as e:
-                logger.warn(f"Failed to add {type} pronounciation {pronounciation} for {ref.id}{f'#{ref.definition}' if ref.definition is not None else ''} into the cache", exc_info=e)
-
-        word = unicodedata.normalize("NFC", entry.entry)
-        try:
-            self._cache_db.execute("INSERT INTO words (word, entry_id, definition_id) VALUES (?, ?, ?)", (word, ref.id, ref.definition))
-        except Exception as e:
-            logger.warn(f"Failed to add word {word} for {ref.id}{f'#{ref.definition}' if ref.definition is not None else ''} into the cache", exc_info=e)
+    @staticmethod
+    def _cache_entries(db: sqlite3.Connection, entries: list[tuple[EntryRef, DictionaryEntry]]):
+        pronounciations = [
+            (_nfc(pronounciation), type, ref.id, ref.definition)
+            for ref, entry in entries
+            for type, pronounciation in entry.pronounciations.items()
+        ]
+        words = [(_nfc(entry.entry), ref.id, ref.definition) for ref, entry in entries]
+        db.executemany("INSERT OR IGNORE INTO pronounciations (pronounciation, type, entry_id, definition_id) VALUES (?, ?, ?, ?)", pronounciations)
+        db.executemany("INSERT OR IGNORE INTO words (word, entry_id, definition_id) VALUES (?, ?, ?)", words)
 
     def get_entry(self, id: EntryId) -> DictionaryEntry:
-        for real_id, in self._cache_db.execute("SELECT entry_id FROM redirects WHERE id = ?", (id,)):
-            return self.get_entry(real_id)
-        for raw_entry, in self._cache_db.execute("SELECT data FROM entries WHERE id = ?", (id,)):
+        entry = self._entry_cache.get(id)
+        if entry is None:
+            entry = self._load_entry(id)
+            self._entry_cache.put(id, entry)
+            if entry.id != id:
+                self._entry_cache.put(entry.id, entry)
+        return entry
+
+    def _load_entry(self, id: EntryId) -> DictionaryEntry:
+        # Follows a redirect, if there is one, in the same query.
+        for real_id, raw_entry in self._cache_db.execute("SELECT id, data FROM entries WHERE id = coalesce((SELECT entry_id FROM redirects WHERE id = ?1), ?1)", (id,)):
             try:
-                return DictionaryEntry.from_dict(json.loads(raw_entry))
+                return DictionaryEntry.from_dict(_load_json(raw_entry))
             except Exception as e:
-                logger.warn(f"Failed to fetch entry {id} from the cache", exc_info=e)
-                self._cache_db.execute("DELETE FROM entries WHERE id = ?", (id,))
+                logger.warning(f"Failed to fetch entry {real_id} from the cache", exc_info=e)
+                with self._cache_write_lock:
+                    self._cache_db.execute("DELETE FROM entries WHERE id = ?", (real_id,))
 
         entry = self._get_entry(id)
-        skip_adding = False
-        if entry.id != id:
-            # Non-canonical ID detected. Check if we have the real record.
-            for real_id in self._cache_db.execute("SELECT id FROM entries WHERE id = ?", (entry.id,)):
-                skip_adding = True
-                break
-
-        if not skip_adding:
-            raw_entry = json.dumps(entry.to_dict())
-            try:
-                self._cache_db.execute("INSERT INTO entries (id, data) VALUES (?, ?)", (entry.id, raw_entry))
-            except Exception as e:
-                logger.warn(f"Failed to add entry {entry.id} into the cache", exc_info=e)
+        added = False
+        try:
+            # Commit the entry on its own first: its super entries may fetch components which refer back to it.
+            with self._cache_transaction() as db:
+                # The entry is already there if we came from a non-canonical ID, or another thread was faster.
+                added = db.execute("INSERT OR IGNORE INTO entries (id, data) VALUES (?, ?)", (entry.id, _dump_json(entry.to_dict()))).rowcount > 0
+                if entry.id != id:
+                    db.execute("INSERT OR IGNORE INTO redirects (id, entry_id) VALUES (?, ?)", (id, entry.id))
+        except Exception as e:
+            logger.warning(f"Failed to add entry {id} into the cache", exc_info=e)
 
-            self._cache_entry(EntryRef(entry.id), entry)
+        if added:
+            # Super entries may fetch their components, so build them before the second transaction starts.
+            cached_entries: list[tuple[EntryRef, DictionaryEntry]] = [(EntryRef(entry.id), entry)]
             for defn_id, defn in entry.definitions.items():
                 if defn.super_entry is not None:
                     super_entry = self._norecurse_get_super_entry(entry, defn_id)
-                    self._cache_entry(EntryRef(entry.id, defn_id), super_entry)
-
-        if entry.id != id:
+                    cached_entries.append((EntryRef(entry.id, defn_id), super_entry))
             try:
-                self._cache_db.execute("INSERT INTO redirects (id, entry_id) VALUES (?, ?)", (id, entry.id))
+                with self._cache_transaction() as db:
+                    self._cache_entries(db, cached_entries)
             except Exception as e:
-                logger.warn(f"Failed to add redirect from {id} to {entry.id} into the cache", exc_info=e)
+                logger.warning(f"Failed to add words of entry {entry.id} into the cache", exc_info=e)
 
         return entry
 
-    def _get_media_data(self, path: str) -> bytes:
+    def _get_media_data(self, path: str) -> tuple[str, bytes]:
         self._ensure_initialized()
         logger.info(f"Fetching media file {path}")
         try:
             url = urljoin(BASE_URL, path)
-            r = self._session.get(url)
-            r.raise_for_status()
-            hasher = hashlib.sha256()
-            hasher.update(r.content)
-            return hasher.hexdigest(), r.content
+            # Hash the file while it is still being downloaded.
+            with self._session.get(url, stream=True) as r:
+                r.raise_for_status()
+                hasher = hashlib.sha256()
+                chunks = []
+                for chunk in r.iter_content(MEDIA_CHUNK_SIZE):
+                    hasher.update(chunk)
+                    chunks.append(chunk)
+            return hasher.hexdigest(), b"".join(chunks)
         except Exception as e:
             raise RuntimeError(f"Failed to get media file {path}") from e
 
@@ -589,16 +745,27 @@ class DictionaryFetcher:
 
         assert data is not None
         if insert_new:
-            try:
-                if has_existing:
+            self._cache_media_data(path, sha256, data, replace=has_existing)
+        return data
+
+    def _cache_media_data(self, path: str, sha256: str, data: bytes, *, replace=False):
+        try:
+            with self._cache_write_lock:
+                if replace:
                     self._cache_db.execute("DELETE FROM media WHERE path = ?", (path,))
                 self._cache_db.execute("INSERT INTO media (path, sha256, data) VALUES (?, ?, ?)", (path, sha256, data))
-            except Exception as e:
-                logger.warn(f"Failed to add media file {path} into the cache", exc_info=e)
-        return data
+        except Exception as e:
+            logger.warning(f"Failed to add media file {path} into the cache", exc_info=e)
+
+    def cache_media(self, path: str):
+        # Unlike get_media_data, this doesn't read the cached contents back.
+        for _exists, in self._cache_db.execute("SELECT 1 FROM media WHERE path = ?", (path,)):
+            return
+        sha256, data = self._get_media_data(path)
+        self._cache_media_data(path, sha256, data)
 
     def lookup_pronounciation(self, pronounciation: str) -> list[EntryId]:
-        pronounciation = unicodedata.normalize("NFC", pronounciation.lower())
+        pronounciation = _nfc(pronounciation.lower())
         # TODO: Implement server-side search.
         return [
             entry_id
@@ -607,7 +774,7 @@ class DictionaryFetcher:
         ]
 
     def lookup_word(self, word: str, force_serverside=False) -> list[EntryRef]:
-        word = unicodedata.normalize("NFC", word.lower())
+        word = _nfc(word.lower())
 
         if not force_serverside:
             local_ret = [
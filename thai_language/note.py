@@ -3,23 +3,28 @@ from dataclasses import dataclass
 import html
 import re
 from copy import copy
+from functools import lru_cache
 from typing import cast
 
 from .types import *
 from .fetch import DictionaryFetcher, EntryNotFound
 from .refs import parse_any_ref, ref_to_string
+from .utils import LRUCache
 
 
+_QUOTED_SEARCH_ESCAPES = str.maketrans({
+    '\\': '\\\\',
+    '"': '\\"',
+    '*': '\\*',
+    '_': '\\_',
+})
+
 def escape_quoted_search(s: str) -> str:
-    return s \
-        .replace('\\', '\\\\') \
-        .replace('"', '\\"') \
-        .replace('*', '\\*') \
-        .replace('_', '\\_')
+    return s.translate(_QUOTED_SEARCH_ESCAPES)
 
 
 def join_nonempty_strings(strs: Iterable[str], sep: str = "<br><br>"):
-    return sep.join((str for str in strs if str != ""))
+    return sep.join([s for s in strs if s])
 
 
 @dataclass
@@ -35,6 +40,15 @@ def format_inline_ref(ref: InlineRef) -> str:
     return "[[" + ret + "]]"
 
 
+COMPONENTS_CACHE_SIZE = 4096
+
+
+# The same pronounciations come up again and again when formatting components.
+@lru_cache(maxsize=4096)
+def _escape_pronounciation(pronounciation: str) -> str:
+    return html.escape(pronounciation.replace(" ", "-"))
+
+
 _INLINE_REF_REGEX = re.compile(r"\[\[(?P<capitalized>!)?(?P<contents>[^]]*)\]\]")
 
 def replace_inline_refs(fetcher: DictionaryFetcher, callback: Callable[[InlineRef], str], inline_refs: str) -> str:
@@ -75,8 +89,8 @@ MediaName = str
 
 
 # FIXME: Replace when Anki ships with Python 3.10
-# @dataclass(kw_only=True)
-@dataclass
+# @dataclass(kw_only=True, slots=True)
+@dataclass(**DATACLASS_SLOTS)
 class WordNote:
     ref: EntryRef
     word: str
@@ -94,8 +108,8 @@ class ClozeNote:
 
 
 # FIXME: Replace when Anki ships with Python 3.10
-# @dataclass(kw_only=True)
-@dataclass
+# @dataclass(kw_only=True, slots=True)
+@dataclass(**DATACLASS_SLOTS)
 class WordComponent:
     id: EntryId
     definition: DefinitionId
@@ -103,10 +117,12 @@ class WordComponent:
     level: int = 0
 
 
+# Formatters keep no per-note state, so one instance may format notes from several threads at once.
 class NoteFormatter:
     _fetcher: DictionaryFetcher
     _pronounciation_type: str
-    _media: dict[str, str]
+    # Component trees keyed by the entry and its decomposed definition.
+    _components_cache: LRUCache[tuple[EntryId, DefinitionId], tuple[WordComponent, ...]]
 
     def __init__(
             self,
@@ -118,7 +134,7 @@ class NoteFormatter:
             pronounciation_type = "Paiboon"
         self._fetcher = fetcher
         self._pronounciation_type = pronounciation_type
-        self._media = {}
+        self._components_cache = LRUCache(COMPONENTS_CACHE_SIZE)
 
     @property
     def pronounciation_type(self):
@@ -128,18 +144,18 @@ class NoteFormatter:
     def fetcher(self):
         return self._fetcher
 
-    def use_media(self, path: MediaPath) -> MediaName:
+    def use_media(self, media: dict[MediaName, MediaPath], path: MediaPath) -> MediaName:
         name = path.replace("/", "_")
-        if name in self._media:
-            assert self._media[name] == path
+        if name in media:
+            assert media[name] == path
         else:
-            self._media[name] = path
+            media[name] = path
         return name
 
     def is_suitable_definition(self, _entry: DictionaryEntry, defn: EntryDefinition):
         if defn.super_entry is not None:
             return False
-        if "The English Alphabet" in (c for cat in defn.categories for c in cat):
+        if any("The English Alphabet" in cat for cat in defn.categories):
             return False
         return True
 
@@ -150,29 +166,29 @@ class NoteFormatter:
         return defns
 
     def format_pronounciation(self, entry: DictionaryEntry) -> str:
-        return html.escape(entry.pronounciations[self.pronounciation_type].replace(" ", "-"))
+        return _escape_pronounciation(entry.pronounciations[self.pronounciation_type])
 
     def format_inline_word(self, entry: DictionaryEntry) -> str:
         pronounciation = self.format_pronounciation(entry)
         entry_str = html.escape(entry.entry)
         return f"<ruby>{entry_str}<rt>{pronounciation}</rt></ruby>"
 
-    def format_word_field(self, entry: DictionaryEntry) -> str:
+    def format_word_field(self, entry: DictionaryEntry, media: dict[MediaName, MediaPath]) -> str:
         pronounciation = self.format_pronounciation(entry)
         entry_str = html.escape(entry.entry)
         word_str = f"{entry_str}[{pronounciation}]"
 
         if entry.sound_url is not None:
-            sound_file = self.use_media(entry.sound_url)
+            sound_file = self.use_media(media, entry.sound_url)
             word_str += f' [sound:{sound_file}]'
         return word_str
 
-    def format_definition_field(self, entry: DictionaryEntry) -> str:
+    def format_definition_field(self, entry: DictionaryEntry, media: dict[MediaName, MediaPath]) -> str:
         defn_strs = []
         for id in self.suitable_definitions(entry):
             defn_str = self.format_definition(entry, id)
             # if defn.image_url is not None:
-            #     image_file = self.use_media(defn.image_url)
+            #     image_file = self.use_media(media, defn.image_url)
             #     defn_str += f'<img src="{image_file}">'
             defn_strs.append(defn_str)
         return "<br>".join(defn_strs)
@@ -217,11 +233,14 @@ class NoteFormatter:
             visited = set()
         return self._build_component(ref, component, visited, 0)
 
+    # Definitions of a word usually share the same decomposition, so only the first one is shown.
+    @staticmethod
+    def _components_definition(entry: DictionaryEntry) -> Optional[EntryDefinition]:
+        return next((defn for defn in entry.definitions.values() if defn.components is not None and defn.super_entry is None), None)
+
     def _build_components(self, entry: DictionaryEntry, visited: set[EntryRef], level: int) -> Generator[WordComponent, None, None]:
-        components = (defn for defn in entry.definitions.values() if defn.components is not None and defn.super_entry is None)
-        try:
-            comp_defn = next(components)
-        except StopIteration:
+        comp_defn = self._components_definition(entry)
+        if comp_defn is None:
             return
         assert comp_defn.components is not None
         for rel_component in comp_defn.components:
@@ -235,8 +254,19 @@ class NoteFormatter:
             visited = set()
         return self._build_components(entry, visited, 0)
 
-    def format_extra_field(self, entry: DictionaryEntry) -> str:
-        components = list(self.build_components(entry))
+    # Same as `build_components` from scratch, but shared between notes which decompose the same definition.
+    def entry_components(self, entry: DictionaryEntry) -> tuple[WordComponent, ...]:
+        comp_defn = self._components_definition(entry)
+        if comp_defn is None:
+            return ()
+        key = (entry.id, comp_defn.id)
+        components = self._components_cache.get(key)
+        if components is None:
+            components = tuple(self.build_components(entry))
+            self._components_cache.put(key, components)
+        return components
+
+    def format_extra_field(self, entry: DictionaryEntry, media: dict[MediaName, MediaPath]) -> str:
         try:
             classifier_ref: Optional[EntryRef] = next((defn.classifiers[0] for defn in entry.definitions.values() if defn.classifiers is not None and len(defn.classifiers) > 0))
         except StopIteration:
@@ -252,7 +282,7 @@ class NoteFormatter:
                 classifier_str += f" {classifier_defn}"
             else:
                 classifier_str += f" - {classifier_defn}"
-        components_str = "<br>".join(map(self.format_component, components))
+        components_str = "<br>".join(map(self.format_component, self.entry_components(entry)))
         extra_str = join_nonempty_strings([classifier_str, components_str])
         return extra_str
 
@@ -280,19 +310,18 @@ class NoteFormatter:
                 raise EntryNotFound()
             if defn.super_entry is None:
                 new_entry = copy(entry)
-                new_entry.definitions = {id: defn for id, defn in entry.definitions.items() if id == ref.definition}
+                new_entry.definitions = {ref.definition: defn}
             else:
                 new_entry = self._fetcher.get_super_entry(entry, ref.definition)
             return new_ref, new_entry
 
     def entry_to_note(self, ref: EntryRef) -> WordNote:
         real_ref, entry = self._ref_to_entry(ref)
-        self._media.clear()
-        word_str = self.format_word_field(entry)
-        definition_str = self.format_definition_field(entry)
-        extra_str = self.format_extra_field(entry)
-        media = copy(self._media)
-        self._media.clear()
+        # Media are collected per call, so that one formatter may be used from several threads.
+        media: dict[MediaName, MediaPath] = {}
+        word_str = self.format_word_field(entry, media)
+        definition_str = self.format_definition_field(entry, media)
+        extra_str = self.format_extra_field(entry, media)
 
         return WordNote(
             ref=real_ref,
@@ -310,10 +339,13 @@ class NoteFormatter:
 
     def cloze_to_note(self, raw_inline_ids: str) -> ClozeNote:
         entries: list[tuple[EntryRef, DictionaryEntry]] = []
+        # Entries resolved while normalizing, so that the second pass doesn't resolve them again.
+        resolved_entries: dict[EntryRef, DictionaryEntry] = {}
         def parse_entries_ids(inline_ref: InlineRef) -> str:
             nonlocal entries
             real_ref, entry = self._ref_to_entry(inline_ref.ref)
             entries.append((real_ref, entry))
+            resolved_entries[real_ref] = entry
             new_inline_ref = dataclasses.replace(inline_ref, ref=real_ref)
             return format_inline_ref(new_inline_ref)
 
@@ -321,7 +353,9 @@ class NoteFormatter:
         inline_ids = replace_inline_refs(self._fetcher, parse_entries_ids, raw_inline_ids)
 
         def emit_pronounciations(inline_ref: InlineRef) -> str:
-            _real_ref, entry = self._ref_to_entry(inline_ref.ref)
+            entry = resolved_entries.get(inline_ref.ref)
+            if entry is None:
+                _real_ref, entry = self._ref_to_entry(inline_ref.ref)
             word = self.format_pronounciation(entry)
             if inline_ref.capitalized:
                 word = word.capitalize()
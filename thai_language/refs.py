@@ -1,10 +1,12 @@
 from typing import Optional
+from functools import lru_cache
 from anki.utils import strip_html
 
 from .types import *
 from .fetch import DictionaryFetcher, parse_entry_url
 
 
+@lru_cache(maxsize=1024)
 def parse_ref(raw_ref: str) -> Optional[EntryRef]:
     try:
         id_parts = raw_ref.split("#", maxsplit=1)
@@ -22,7 +24,10 @@ def ref_to_string(ref: EntryRef) -> str:
 
 
 def parse_any_ref(fetcher: DictionaryFetcher, raw_ref: str) -> list[EntryRef]:
-    raw_ref = strip_html(raw_ref).strip()
+    # Fields are usually plain text already; don't call into the backend for them.
+    if "<" in raw_ref or "&" in raw_ref:
+        raw_ref = strip_html(raw_ref)
+    raw_ref = raw_ref.strip()
     if raw_ref == "":
         return []
 
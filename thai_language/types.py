@@ -1,4 +1,5 @@
 from collections.abc import Callable
+import sys
 import dataclasses
 from dataclasses import dataclass, field
 from typing import Any, Literal, Optional, Union
@@ -7,26 +8,32 @@ from typing import Any, Literal, Optional, Union
 DEFAULT_DEFINITION: Literal["#"] = "#"
 
 
+# FIXME: Replace with `slots=True` when Anki ships with Python 3.10
+DATACLASS_SLOTS: dict[str, Any] = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+
 EntryId = int
 DefinitionId = Union[str, Literal["#"]]
 
 
 # We implement (de-)serialization machinery by ourselves; better than bundling marshmallow...
-def _adjust_dict(f: Callable[[Any], Any], d: dict[str, Any], name: str):
-    d[name] = f(d.get(name))
-
-
-@dataclass(frozen=True)
+@dataclass(frozen=True, **DATACLASS_SLOTS)
 class EntryRef:
     id: EntryId
     definition: Optional[DefinitionId] = None
 
     @staticmethod
     def from_dict(vals: dict[str, Any]) -> "EntryRef":
-        return EntryRef(**vals)
+        return EntryRef(
+            id=vals["id"],
+            definition=vals.get("definition"),
+        )
 
     def to_dict(self) -> dict[str, Any]:
-        return dataclasses.asdict(self)
+        return {
+            "id": self.id,
+            "definition": self.definition,
+        }
 
 
 SELF_REFERENCE: Literal["self"] = "self"
@@ -39,6 +46,12 @@ def _parse_related_entries(raw: Optional[list[dict[str, Any]]]) -> Optional[list
         return None
 
 
+def _dump_related_entries(refs: Optional[list[EntryRef]]) -> Optional[list[dict[str, Any]]]:
+    if refs is None:
+        return None
+    return [ref.to_dict() for ref in refs]
+
+
 ComponentsList = list[Union[EntryRef, Literal["self"]]]
 
 def _parse_components(raw: Optional[list[Union[dict[str, Any], Literal["self"]]]]) -> Optional[ComponentsList]:
@@ -48,6 +61,12 @@ def _parse_components(raw: Optional[list[Union[dict[str, Any], Literal["self"]]]
         return None
 
 
+def _dump_components(components: Optional[ComponentsList]) -> Optional[list[Union[dict[str, Any], Literal["self"]]]]:
+    if components is None:
+        return None
+    return [SELF_REFERENCE if comp == SELF_REFERENCE else comp.to_dict() for comp in components]
+
+
 # FIXME: Replace when Anki ships with Python 3.10
 # @dataclass(kw_only=True)
 @dataclass
@@ -66,15 +85,34 @@ class EntryDefinition:
 
     @staticmethod
     def from_dict(vals: dict[str, Any]) -> "EntryDefinition":
-        nvals = vals.copy()
-        _adjust_dict(_parse_components, nvals, "components")
-        _adjust_dict(_parse_related_entries, nvals, "classifiers")
-        _adjust_dict(_parse_related_entries, nvals, "related")
-        _adjust_dict(_parse_related_entries, nvals, "synonyms")
-        return EntryDefinition(**nvals)
+        return EntryDefinition(
+            id=vals["id"],
+            definition=vals["definition"],
+            classes=vals["classes"],
+            super_entry=vals.get("super_entry"),
+            is_common=vals.get("is_common", False),
+            categories=vals.get("categories", []),
+            components=_parse_components(vals.get("components")),
+            classifiers=_parse_related_entries(vals.get("classifiers")),
+            related=_parse_related_entries(vals.get("related")),
+            synonyms=_parse_related_entries(vals.get("synonyms")),
+            image_url=vals.get("image_url"),
+        )
 
     def to_dict(self) -> dict[str, Any]:
-        return dataclasses.asdict(self)
+        return {
+            "id": self.id,
+            "definition": self.definition,
+            "classes": list(self.classes),
+            "super_entry": self.super_entry,
+            "is_common": self.is_common,
+            "categories": [list(cats) for cats in self.categories],
+            "components": _dump_components(self.components),
+            "classifiers": _dump_related_entries(self.classifiers),
+            "related": _dump_related_entries(self.related),
+            "synonyms": _dump_related_entries(self.synonyms),
+            "image_url": self.image_url,
+        }
 
 
 # FIXME: Replace when Anki ships with Python 3.10
@@ -86,17 +124,27 @@ class DictionaryEntry:
     pronounciations: dict[str, str]
     definitions: dict[DefinitionId, EntryDefinition]
     sound_url: Optional[str] = None
+    # Super entries already built from the definitions; not serialized.
+    _super_entries: dict[DefinitionId, "DictionaryEntry"] = field(default_factory=dict, init=False, repr=False, compare=False)
 
     @staticmethod
     def from_dict(vals: dict[str, Any]) -> "DictionaryEntry":
-        nvals = vals.copy()
-        _adjust_dict(lambda ds: {(d := EntryDefinition.from_dict(rd)).id: d for rd in ds}, nvals, "definitions")
-        return DictionaryEntry(**nvals)
+        return DictionaryEntry(
+            id=vals["id"],
+            entry=vals["entry"],
+            pronounciations=vals["pronounciations"],
+            definitions={(d := EntryDefinition.from_dict(rd)).id: d for rd in vals["definitions"]},
+            sound_url=vals.get("sound_url"),
+        )
 
     def to_dict(self) -> dict[str, Any]:
-        ret = dataclasses.asdict(self)
-        _adjust_dict(lambda ds: list(ds.values()), ret, "definitions")
-        return ret
+        return {
+            "id": self.id,
+            "entry": self.entry,
+            "pronounciations": dict(self.pronounciations),
+            "definitions": [defn.to_dict() for defn in self.definitions.values()],
+            "sound_url": self.sound_url,
+        }
 
     @property
     def first_definition(self):
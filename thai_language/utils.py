@@ -1,4 +1,5 @@
-from typing import Any, TypeVar, cast
+from typing import Generic, Optional, TypeVar
+from collections import OrderedDict
 from collections.abc import Callable
 import threading
 
@@ -12,13 +13,52 @@ def norecurse(*, getter: Callable = lambda *args: args) -> Callable[[Callable],
     def decorator(wrapped: Callable) -> Callable:
         storage = threading.local()
         def f(*args, **kwargs):
+            keys = getattr(storage, "keys", None)
+            if keys is None:
+                keys = storage.keys = set()
             key = getter(*args, **kwargs)
-            if key in storage.__dict__:
+            if key in keys:
                 raise RuntimeError("Unexpected recursion")
-            storage.__dict__[key] = True
-            # Fix this in Python 3.11:
-            result = cast(Any, wrapped)(*args, **kwargs)
-            del storage.__dict__[key]
-            return result
+            keys.add(key)
+            # Don't leave the key behind if the call fails.
+            try:
+                return wrapped(*args, **kwargs)
+            finally:
+                keys.discard(key)
         return f
     return decorator
+
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+
+# A thread-safe mapping which keeps at most `maxsize` most recently used items.
+class LRUCache(Generic[K, V]):
+    _items: OrderedDict[K, V]
+    _lock: threading.Lock
+    _maxsize: int
+
+    def __init__(self, maxsize: int):
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._maxsize = maxsize
+
+    def get(self, key: K) -> Optional[V]:
+        with self._lock:
+            try:
+                self._items.move_to_end(key)
+            except KeyError:
+                return None
+            return self._items[key]
+
+    def put(self, key: K, value: V):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            if len(self._items) > self._maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()